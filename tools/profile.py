@@ -13,26 +13,41 @@ except ImportError:
     print ("Try: sudo yum install python-argparse")
     exit(1)
 
+import bisect
+import collections
 import json
 import os
 import psutil
+import select
 import tempfile
 import shutil
 import subprocess
 import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Optional, parses large configs and writes reports faster.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serialize console output from concurrently checked queries.
+PRINT_LOCK = threading.Lock()
+
 def red(msg):
-    return "\033[41m\033[1;30m %s \033[0m" % str(msg)
+    return "\033[41m\033[1;30m %s \033[0m" % (msg,)
 
 def yellow(msg):
-    return "\033[43m\033[1;30m %s \033[0m" % str(msg)
+    return "\033[43m\033[1;30m %s \033[0m" % (msg,)
 
 def green(msg):
-    return "\033[42m\033[1;30m %s \033[0m" % str(msg)
+    return "\033[42m\033[1;30m %s \033[0m" % (msg,)
 
 def blue(msg):
-    return "\033[46m\033[1;30m %s \033[0m" % str(msg)
+    return "\033[46m\033[1;30m %s \033[0m" % (msg,)
 
 KB = 1024 * 1024
 RANGES = {
@@ -43,12 +58,18 @@ RANGES = {
     "fds": (6, 12, 50),
     "duration": (0.8, 1, 3),
 }
+# The sorted thresholds of each ranked metric, for bisecting.
+RANKED_METRICS = tuple((key, ranges) for key, ranges in RANGES.items()
+    if key != "colors")
 
 def queries_from_config(config_path):
     config = {}
     try:
-        with open(config_path, "r") as fh:
-            config = json.loads(fh.read())
+        with open(config_path, "rb") as fh:
+            if orjson is not None:
+                config = orjson.loads(fh.read())
+            else:
+                config = json.load(fh)
     except Exception as e:
         print ("Cannot open/parse config: %s" % str(e))
         exit(1)
@@ -60,66 +81,143 @@ def queries_from_config(config_path):
         queries[query["name"]] = query["query"]
     return queries
 
+def write_json_line(fh, data):
+    """Append data to a newline-delimited JSON stream and flush it."""
+    if orjson is not None:
+        line = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    else:
+        line = json.dumps(data, sort_keys=True).encode("utf-8")
+    fh.write(line + b"\n")
+    fh.flush()
+
 def queries_from_tables(path, restrict):
     """Construct select all queries from all tables."""
     # Let the caller limit the tables
-    restrict_tables = [t.strip() for t in restrict.split(",")]
-
-    tables = []
-    for base, folders, files in os.walk(path):
-        for spec in files:
-            spec_platform = os.path.basename(base)
-            table_name = spec.split(".table", 1)[0]
-            if spec_platform not in ["x", platform]:
-                continue
-            # Generate all tables to select from, with abandon.
-            tables.append("%s.%s" % (spec_platform, table_name))
-
-    tables = [t for t in tables if t.split(".")[1] not in restrict_tables]
+    restrict_tables = set(t.strip() for t in restrict.split(","))
+    spec_platforms = ("x", platform)
+
     queries = {}
-    for table in tables:
-        queries[table] = "SELECT * FROM %s;" % table.split(".", 1)[1]
+    def scan(path, spec_platform=None):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Only descend into specs that apply to this platform.
+                    if entry.name in spec_platforms:
+                        scan(entry.path, entry.name)
+                    continue
+                if spec_platform is None:
+                    continue
+                table_name = entry.name.split(".table", 1)[0]
+                if table_name in restrict_tables:
+                    continue
+                # Generate all tables to select from, with abandon.
+                queries["%s.%s" % (spec_platform, table_name)] = (
+                    "SELECT * FROM %s;" % table_name)
+    scan(path)
     return queries
 
-def get_stats(p, interval=1):
-    """Run psutil and downselect the information."""
-    utilization = p.cpu_percent(interval=interval)
-    return {
-        "utilization": utilization,
-        "counters": p.io_counters() if sys.platform != "darwin" else None,
-        "fds": p.num_fds(),
-        "cpu_times": p.cpu_times(),
-        "memory": p.memory_info_ex(),
-    }
+class ThrottledProcess(object):
+    """Wrap a psutil.Process and memoize its slower changing metrics.
+
+    The CPU counters are read on every call, the IO counters, memory and
+    file descriptors are refreshed at most once every interval seconds.
+    """
+
+    def __init__(self, process, interval):
+        self.process = process
+        self.interval = interval
+        self._last = {}
+
+    def _throttle(self, attr):
+        now = time.monotonic()
+        last = self._last.get(attr)
+        if last is None or now - last[0] >= self.interval:
+            last = (now, getattr(self.process, attr)())
+            self._last[attr] = last
+        return last[1]
+
+    def cpu_percent(self):
+        return self.process.cpu_percent(None)
+
+    def cpu_times(self):
+        return self.process.cpu_times()
 
-def check_leaks_linux(shell, query, supp_file=None):
+    def io_counters(self):
+        return self._throttle("io_counters")
+
+    def num_fds(self):
+        return self._throttle("num_fds")
+
+    def memory_info(self):
+        return self._throttle("memory_info")
+
+# psutil has no IO counters on darwin, pick the accessor once at import.
+if sys.platform == "darwin":
+    get_io_counters = lambda tp: None
+else:
+    get_io_counters = ThrottledProcess.io_counters
+
+def get_stats(tp):
+    """Run psutil and downselect the information.
+
+    The CPU utilization is measured since the previous call, the caller must
+    prime the counter with p.cpu_percent(None) and then wait the interval.
+    """
+    # Bundle the reads of the same /proc (or sysctl) sources into one.
+    with tp.process.oneshot():
+        return {
+            "utilization": tp.cpu_percent(),
+            "counters": get_io_counters(tp),
+            "fds": tp.num_fds(),
+            "cpu_times": tp.cpu_times(),
+            "memory": tp.memory_info(),
+        }
+
+def check_leaks_linux(shell, query, count=1, supp_file=None):
     """Run valgrind using the shell and a query, parse leak reports."""
     start_time = time.time()
-    suppressions = "" if supp_file is None else "--suppressions=%s" % supp_file
-    cmd = "valgrind --tool=memcheck %s %s --query=\"%s\"" % (
-        suppressions, shell, query) 
+    cmd = ["valgrind", "--tool=memcheck"]
+    if supp_file is not None:
+        cmd.append("--suppressions=%s" % supp_file)
+    cmd += [shell, "--query", query, "--iterations", str(count)]
+    # Only the valgrind report on stderr is parsed, discard the query output.
     proc = subprocess.Popen(cmd,
-        shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
     summary = {
         "definitely": None,
         "indirectly": None,
         "possibly": None,
     }
-    for line in stderr.split("\n"):
+    # Parse the report as it is written and stop at the leak summary.
+    for line in proc.stderr:
         for key in summary:
             if line.find(key) >= 0:
                 summary[key] = line.split(":")[1].strip()
+        if all(summary.values()):
+            break
+    proc.stderr.close()
+    proc.wait()
     return summary
 
-def check_leaks_darwin(shell, query):
+def check_leaks_darwin(shell, query, count=1):
     start_time = time.time()
-    proc = subprocess.Popen([shell, "--query", query, "--delay", "1"],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc = subprocess.Popen([shell, "--query", query,
+        "--iterations", str(count), "--delay", "1"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # leaks inspects a live process, sample it until the query exits. The
+    # exit is waited on with a kqueue that also paces the samples.
+    kq = select.kqueue()
+    kq.control([select.kevent(proc.pid, filter=select.KQ_FILTER_PROC,
+        flags=select.KQ_EV_ADD, fflags=select.KQ_NOTE_EXIT)], 0)
+    step = 0.25
+
     leak_checks = None
-    while proc.poll() is None:
+    exited = False
+    while not exited:
         leaks = subprocess.Popen(["leaks", "%s" % proc.pid],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
         stdout, _ = leaks.communicate()
         try:
             for line in stdout.split("\n"):
@@ -127,120 +225,213 @@ def check_leaks_darwin(shell, query):
                     leak_checks = line.split(":")[1].strip()
         except:
             print (stdout)
+        exited = len(kq.control(None, 1, step)) > 0
+    kq.close()
+    proc.wait()
     return {"definitely": leak_checks}
 
-def check_leaks(shell, query, supp_file=None):
+def check_leaks(shell, query, count=1, supp_file=None):
     if sys.platform == "darwin":
-        return check_leaks_darwin(shell, query)
+        return check_leaks_darwin(shell, query, count=count)
     else:
-        return check_leaks_linux(shell, query, supp_file=supp_file)
+        return check_leaks_linux(shell, query, count=count,
+            supp_file=supp_file)
 
-def profile_leaks(shell, queries, count=1, rounds=1, supp_file=None):
-    report = {}
-    for name, query in queries.iteritems():
+def profile_query_leaks(shell, query, count=1, supp_file=None):
+    """Check a single query for leaks and display the summary."""
+    with PRINT_LOCK:
         print ("Analyzing leaks in query: %s" % query)
-        # Apply count
-        summary = check_leaks(shell, query * count, supp_file)
-        display = []
-        for key in summary:
-            output = summary[key]
-            if output is not None and output[0] != "0":
-                # Add some fun colored output if leaking.
-                if key == "definitely":
-                    output = red(output)
-                if key == "indirectly":
-                    output = yellow(output)
-            display.append("%s: %s" % (key, output))
-        print ("  %s" % "; ".join(display))
-        report[name] = summary
+    # The run wrapper repeats the query count times.
+    summary = check_leaks(shell, query, count=count, supp_file=supp_file)
+    display = []
+    for key in summary:
+        output = summary[key]
+        if output is not None and output[0] != "0":
+            # Add some fun colored output if leaking.
+            if key == "definitely":
+                output = red(output)
+            if key == "indirectly":
+                output = yellow(output)
+        display.append("%s: %s" % (key, output))
+    with PRINT_LOCK:
+        print ("  %s: %s" % (query, "; ".join(display)))
+    return summary
+
+def profile_leaks(shell, queries, count=1, rounds=1, supp_file=None,
+        concurrency=1):
+    """Check each (name, query) pair for leaks, return the summaries."""
+    report = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(profile_query_leaks, shell, query,
+            count=count, supp_file=supp_file): name
+            for name, query in queries}
+        for future in as_completed(futures):
+            report[futures[future]] = future.result()
     return report
 
-def run_query(shell, query, timeout=0, count=1):
-    """Execute the osquery run testing wrapper with a setup/teardown delay."""
-    start_time = time.time()
-    proc = subprocess.Popen(
-        [shell, "--query", query, "--iterations", str(count),
-            "--delay", "1"],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    p = psutil.Process(pid=proc.pid)
+class QueryRun(object):
+    """A round of a query executing in the run wrapper, and its samples."""
 
-    delay = 0
-    step = 0.5
+    # The run wrapper sleeps this many seconds before and after the query.
+    SETUP_DELAY = 1
+
+    def __init__(self, shell, name, query, round=0, timeout=0, count=1,
+            step=0.5):
+        self.name = name
+        self.query = query
+        self.round = round
+        self.timeout = timeout
+        self.start_time = time.monotonic()
+        self.end_time = None
+        # The output is never read, an unread pipe would stall a chatty query.
+        self.proc = psutil.Popen(
+            [shell, "--query", query, "--iterations", str(count),
+                "--delay", str(self.SETUP_DELAY)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.proc.cpu_percent(None)
 
-    percents = []
-    # Calculate the CPU utilization in intervals of 1 second.
-    while p.is_running():
+        # Refresh the memory and file descriptor counts every other step, the
+        # teardown delay keeps them sampled once the query has finished.
+        self.tp = ThrottledProcess(self.proc, interval=1.5 * step)
+        self.sampling = True
+        self.percents = []
+        self.stats = None
+
+    def sample(self):
+        """Sample the running process, kill it once past the timeout."""
+        if not self.sampling:
+            return
         try:
-            stats = get_stats(p, step)
-            percents.append(stats["utilization"])
-        except psutil.AccessDenied as e:
-            break
-        delay += step
-        if timeout > 0 and delay >= timeout + 2:
-            proc.kill()
-            break
-    duration = time.time() - start_time - 2;
+            self.stats = get_stats(self.tp)
+            self.percents.append(self.stats["utilization"])
+        except (psutil.AccessDenied, psutil.NoSuchProcess) as e:
+            self.sampling = False
+            return
+        delay = time.monotonic() - self.start_time
+        if self.timeout > 0 and delay >= self.timeout + 2 * self.SETUP_DELAY:
+            self.proc.kill()
+            self.sampling = False
 
-    utilization = [p for p in percents if p != 0]
-    if len(utilization) == 0:
-        avg_utilization = 0
-    else:
-        avg_utilization = sum(utilization)/len(utilization)
-
-    return {
-        "utilization": avg_utilization,
-        "duration": duration,
-        "memory": stats["memory"].rss,
-        "user_time": stats["cpu_times"].user,
-        "system_time": stats["cpu_times"].system,
-        "cpu_time": stats["cpu_times"].user + stats["cpu_times"].system,
-        "fds": stats["fds"],
-    }
+    def result(self):
+        """Summarize the samples once the process has exited.
 
-def summary(results, display=False):
-    """Map the results to simple thresholds.""" 
-    def rank(value, ranges):
-        for i, r in enumerate(ranges):
-            if value < r: return i
-        return len(ranges)
+        Returns None if the process exited before it was ever sampled.
+        """
+        if self.stats is None:
+            return None
+        duration = self.end_time - self.start_time - 2 * self.SETUP_DELAY
+
+        utilization = [p for p in self.percents if p != 0]
+        if len(utilization) == 0:
+            avg_utilization = 0
+        else:
+            avg_utilization = sum(utilization)/len(utilization)
+
+        stats = self.stats
+        return {
+            "utilization": avg_utilization,
+            "duration": duration,
+            "memory": stats["memory"].rss,
+            "user_time": stats["cpu_times"].user,
+            "system_time": stats["cpu_times"].system,
+            "cpu_time": stats["cpu_times"].user + stats["cpu_times"].system,
+            "fds": stats["fds"],
+        }
+
+def rank_result(result):
+    """Map the metrics of a single result to simple thresholds."""
+    ranked = {}
+    for key, ranges in RANKED_METRICS:
+        if key not in result:
+            continue
+        # The rank is the number of thresholds at or below the value.
+        ranked[key] = bisect.bisect_right(ranges, result[key])
+    return ranked
+
+def display_ranked(name, result, ranked):
+    colors = RANGES["colors"]
+    # Build the line once rather than printing each colored metric.
+    print ("%s: %s" % (name, " ".join(
+        colors[v]("%s: %s (%s)" % (key, v, result[key]))
+        for key, v in ranked.items())))
 
+def summary(results, display=False):
+    """Map the results to simple thresholds."""
     summary_results = {}
-    for name, result in results.iteritems():
-        summary_result = {}
-        for key in RANGES:
-            if key == "colors":
-                continue
-            if key not in result:
-                continue
-            summary_result[key] = rank(result[key], RANGES[key])
+    for name, result in results.items():
+        summary_result = rank_result(result)
         if display:
-            print ("%s:" % name, end=" ")
-            for key, v in summary_result.iteritems():
-                print (RANGES["colors"][v](
-                    "%s: %s (%s)" % (key, v, result[key])), end=" ")
-            print ("")
+            display_ranked(name, result, summary_result)
         summary_results[name] = summary_result
     return summary_results
 
-def profile(shell, queries, timeout=0, count=1, rounds=1):
-    report = {}
-    for name, query in queries.iteritems():
-        print ("Profiling query: %s" % query)
-        results = {}
-        for i in range(rounds):
-            result = run_query(shell, query, timeout=timeout, count=count)
-            summary({"%s (%d/%d)" % (name, i+1, rounds): result}, display=True)
-            # Store each result round to return an average.
-            for k, v in result.iteritems():
-                results[k] = results.get(k, [])
-                results[k].append(v)
-        average_results = {}
-        for k in results:
-            average_results[k] = sum(results[k])/len(results[k])
-        report[name] = average_results
-        summary({"%s   avg" % name: report[name]}, display=True)
-    return report
+def profile(shell, queries, timeout=0, count=1, rounds=1, concurrency=1):
+    """Profile each (name, query) pair, yield each average and its ranks.
+
+    The (name, average, ranks) of a query are yielded as soon as its last
+    round completes, nothing is kept once the caller has consumed them.
+    """
+    step = 0.5
+    pending = collections.deque(queries)
+    # Map each running query process to its QueryRun.
+    alive = {}
+    # Accumulate each query's result rounds to return an average.
+    sums = collections.defaultdict(lambda: collections.defaultdict(float))
+    sampled = collections.Counter()
+
+    def start(name, query, round=0):
+        if round == 0:
+            print ("Profiling query: %s" % query)
+        run = QueryRun(shell, name, query, round=round, timeout=timeout,
+            count=count, step=step)
+        alive[run.proc] = run
+
+    def on_exit(proc):
+        alive[proc].end_time = time.monotonic()
+
+    try:
+        while pending or alive:
+            while pending and len(alive) < concurrency:
+                start(*pending.popleft())
+            # A single wait on every running query paces the sampling, and
+            # reaps the queries that exit in the meantime.
+            gone, running = psutil.wait_procs(list(alive), timeout=step,
+                callback=on_exit)
+            for proc in running:
+                alive[proc].sample()
+            for proc in gone:
+                run = alive.pop(proc)
+                label = "%s (%d/%d)" % (run.name, run.round+1, rounds)
+                result = run.result()
+                if result is None:
+                    print ("%s: %s" % (label, red("exited before sampling")))
+                else:
+                    summary({label: result}, display=True)
+                    sampled[run.name] += 1
+                    for k, v in result.items():
+                        sums[run.name][k] += v
+                if run.round + 1 < rounds:
+                    start(run.name, run.query, round=run.round + 1)
+                    continue
+                # Average over the sampled rounds, skip a query without any.
+                count_sampled = sampled.pop(run.name, 0)
+                round_sums = sums.pop(run.name, {})
+                if count_sampled == 0:
+                    continue
+                average_results = {}
+                for k, v in round_sums.items():
+                    average_results[k] = v/count_sampled
+                ranked = rank_result(average_results)
+                display_ranked("%s   avg" % run.name, average_results, ranked)
+                yield run.name, average_results, ranked
+    finally:
+        # Do not leave queries running when profiling stops early.
+        for proc in alive:
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
+        psutil.wait_procs(list(alive))
 
 if __name__ == "__main__":
     platform = sys.platform
@@ -255,7 +446,7 @@ if __name__ == "__main__":
     parser.add_argument("--config", default=None,
         help="Use scheduled queries from a config.")
     parser.add_argument("--output", default=None,
-        help="Write JSON output to file.")
+        help="Write newline-delimited JSON output to file.")
     parser.add_argument("--summary", default=False, action="store_true",
         help="Write a summary instead of stats.")
     parser.add_argument("--query", default=None,
@@ -266,6 +457,8 @@ if __name__ == "__main__":
         help="Number of times to run each query.")
     parser.add_argument("--rounds", default=1, type=int,
         help="Run the profile for multiple rounds and use the average.")
+    parser.add_argument("--concurrency", default=1, type=int,
+        help="Number of queries to profile at the same time.")
     parser.add_argument("--leaks", default=False, action="store_true",
         help="Check for memory leaks instead of performance.")
     parser.add_argument("--suppressions", default=None,
@@ -275,6 +468,12 @@ if __name__ == "__main__":
         help="Path to osquery run wrapper.")
     args = parser.parse_args()
 
+    if args.rounds < 1:
+        print ("Invalid --rounds: %d" % (args.rounds))
+        exit(1)
+    if args.concurrency < 1:
+        print ("Invalid --concurrency: %d" % (args.concurrency))
+        exit(1)
     if not os.path.exists(args.shell):
         print ("Cannot find --daemon: %s" % (args.shell))
         exit(1)
@@ -292,20 +491,27 @@ if __name__ == "__main__":
         queries["manual"] = args.query
     else:
         queries = queries_from_tables(args.tables, args.restrict)
+    # Profile from a fixed sequence of (name, query) pairs.
+    queries = tuple(queries.items())
     
     if args.leaks:
         results = profile_leaks(args.shell, queries, count=args.count,
-            rounds=args.rounds, supp_file=args.suppressions)
+            rounds=args.rounds, supp_file=args.suppressions,
+            concurrency=args.concurrency)
         exit(0)
 
+    # Write each query's stats, or summary, as one JSON line when it is done.
+    output = None
+    if args.output is not None:
+        output = open(args.output, "wb")
+
     # Start the profiling!
-    results = profile(args.shell, queries,
-        timeout=args.timeout, count=args.count, rounds=args.rounds)
-
-    if args.output is not None and not args.summary:
-        with open(args.output, "w") as fh:
-            fh.write(json.dumps(results, indent=1, sort_keys=True))
-    if args.summary is True:
-        with open(args.output, "w") as fh:
-            fh.write(json.dumps(summary(results), indent=1, sort_keys=True))
+    for name, result, ranked in profile(args.shell, queries,
+            timeout=args.timeout, count=args.count, rounds=args.rounds,
+            concurrency=args.concurrency):
+        if output is not None:
+            write_json_line(output, {name: ranked if args.summary else result})
+
+    if output is not None:
+        output.close()
 